@@ -3,7 +3,7 @@ MT5 trading bot for XAU/USD with a 50-pip take-profit and 20-pip stop-loss.
 
 - Trades at IST 10:35, 11:35, 12:35, 13:35, 14:35, 16:35, 17:35, 18:35, 19:35, 20:35
   (we convert these IST targets to SERVER TIME automatically each day).
-- Direction from the preceding 5-minute candle colour (closed bar via copy_rates_from).
+- Direction from the preceding 5-minute candle colour (closed bar via copy_rates_from_pos, falling back to copy_rates_from).
 - Lot scaling (QuantTekel):
     * "quanttekel" mode: DD-based sizing with min 0.02 lots, compounding 0.02 per $100 of virtual DD,
       and a hard cap so SL cannot exceed the daily DD ($37.50 here).
@@ -19,12 +19,18 @@ from datetime import datetime, timedelta, date, time as dt_time, timezone
 import time
 from pathlib import Path
 import csv
+import io
 import threading
+import heapq
+import queue
+import math
+from concurrent.futures import Future, TimeoutError as FuturesTimeout
 import smtplib, ssl
+from contextlib import contextmanager
 from email.message import EmailMessage
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple
 import sys
-import os
+import atexit
 import re  # for robust time parsing
 
 # ========= CONFIG =========
@@ -45,12 +51,16 @@ IST_TRADE_TIMES = [
 SL_PIPS = 20
 TP_PIPS = 50
 PIP_SIZE = 0.10
+# Price distances derived once at import; changing SL_PIPS/TP_PIPS/PIP_SIZE at runtime needs a re-import
+_SL_DIST = SL_PIPS * PIP_SIZE
+_TP_DIST = TP_PIPS * PIP_SIZE
 DEVIATION = 20
 MAGIC = 20250901
 
 # Heartbeat status in console (every second)
 HEARTBEAT_EVERY_SEC = True
 HEARTBEAT_SINGLE_LINE = True
+HEARTBEAT_FLUSH_SECONDS = 5     # single-line HB is flushed this often (and on each new minute)
 
 # Email (use app password for Gmail)
 EMAIL_SENDER   = "you@example.com"
@@ -58,10 +68,16 @@ EMAIL_PASSWORD = "your_app_password"
 EMAIL_RECEIVER = "you@example.com"
 SMTP_HOST = "smtp.gmail.com"
 SMTP_PORT = 465
+EMAIL_RETRY_SECONDS = 60        # wait before retrying reports after a combine/SMTP failure
 
 # Logging
 LOG_DIR = Path("trade_logs")
 LOG_DIR.mkdir(exist_ok=True)
+LOG_HEADER = ["Date","Time","Signal","Volume","Entry","SL","TP","Result","Profit","Balance"]
+LOG_HEADER_LINE = (",".join(LOG_HEADER) + "\r\n").encode()  # as written by csv.writer
+# One trade row in the same dialect. No field needs quoting: signal and result
+# come from fixed word lists and the rest are dates/times/numbers.
+_ROW_FMT = "{date},{time},{sig},{vol:.2f},{entry:.3f},{sl:.3f},{tp:.3f},{res},{pnl:.2f},{bal:.2f}\r\n"
 
 # ===== Lot sizing mode =====
 LOT_MODE = "quanttekel"
@@ -84,8 +100,35 @@ MANUAL_SERVER_DELTA_MINUTES: Optional[int] = 180  # set None to auto-estimate by
 # Trigger window tolerance (seconds)
 FIRE_WINDOW_SECONDS = 10
 
+# Longest main-loop sleep when the heartbeat is off (still catches day rollover)
+IDLE_POLL_SECONDS = 60
+
+# Max wait for the main loop's tick fetch before extrapolating server time
+TICK_TIMEOUT_SECONDS = 0.25
+
 # ==========================
 
+# ==== Background console log ====
+# Per-trade messages are queued and written by a daemon thread so stdout I/O stays
+# off the path between slot fire and watcher spawn. Startup/shutdown still print.
+_LOG_Q: queue.Queue = queue.Queue()
+_LOG_STOP = object()  # queued at shutdown to end the drain thread
+
+def _log_drain():
+    while True:
+        line = _LOG_Q.get()
+        if line is _LOG_STOP:
+            return
+        try:
+            sys.stdout.write(line + "\n")
+            if not (HEARTBEAT_EVERY_SEC and HEARTBEAT_SINGLE_LINE):
+                sys.stdout.flush()  # otherwise the heartbeat loop flushes on its schedule
+        except Exception:
+            pass  # no usable console (closed, redirect error, pythonw): drop the line
+
+def _log(line: str):
+    _LOG_Q.put(line)
+
 def init_mt5():
     if not mt5.initialize():
         raise RuntimeError(f"MT5 init error: {mt5.last_error()}")
@@ -96,6 +139,7 @@ def init_mt5():
         raise RuntimeError(f"{SYMBOL} not found in Market Watch")
     if not info.visible:
         mt5.symbol_select(SYMBOL, True)
+    refresh_symbol_meta()
 
 def shutdown_mt5():
     mt5.shutdown()
@@ -107,7 +151,15 @@ def lot_size_balance(balance: float) -> float:
 def is_last_day_of_month(dt: datetime) -> bool:
     return (dt + timedelta(days=1)).month != dt.month
 
-def send_email(subject: str, body: str, filepath: Optional[Path] = None):
+@contextmanager
+def smtp_session():
+    """Yields one logged-in SMTP_SSL connection so several reports share a TLS handshake."""
+    context = ssl.create_default_context()
+    with smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, context=context) as server:
+        server.login(EMAIL_SENDER, EMAIL_PASSWORD)
+        yield server
+
+def _send_via(server, subject: str, body: str, filepath: Optional[Path] = None):
     msg = EmailMessage()
     msg["From"] = EMAIL_SENDER
     msg["To"] = EMAIL_RECEIVER
@@ -116,32 +168,60 @@ def send_email(subject: str, body: str, filepath: Optional[Path] = None):
     if filepath is not None and Path(filepath).exists():
         with open(filepath, "rb") as f:
             msg.add_attachment(f.read(), maintype="application", subtype="csv", filename=Path(filepath).name)
-    context = ssl.create_default_context()
-    with smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, context=context) as server:
-        server.login(EMAIL_SENDER, EMAIL_PASSWORD)
-        server.send_message(msg)
+    server.send_message(msg)
     print(f"[EMAIL] Sent: {subject} -> {EMAIL_RECEIVER} {'(with attachment)' if filepath else '(no attachment)'}")
 
+def send_email(subject: str, body: str, filepath: Optional[Path] = None):
+    with smtp_session() as server:
+        _send_via(server, subject, body, filepath)
+
 def combine_logs(output_file: Path, start_date: date, end_date: date):
-    header = ["Date","Time","Signal","Volume","Entry","SL","TP","Result","Profit","Balance"]
-    rows = []
-    d = start_date
-    while d <= end_date:
-        f = LOG_DIR / f"{d.isoformat()}.csv"
-        if f.exists():
-            with open(f, newline="") as fp:
-                r = csv.reader(fp)
-                _ = next(r, None)
-                rows.extend([row for row in r])
-        d += timedelta(days=1)
-    with open(output_file, "w", newline="") as out:
-        w = csv.writer(out)
-        w.writerow(header)
-        w.writerows(rows)
-    print(f"[LOG] Combined {len(rows)} rows -> {output_file.name}")
-
-def get_candle_color(candle_start: datetime):
-    rates = mt5.copy_rates_from(SYMBOL, mt5.TIMEFRAME_M5, candle_start, 1)
+    # Daily files share one schema, so their bodies are copied as raw bytes;
+    # only a file whose header differs is re-parsed through csv.
+    rows = 0
+    with open(output_file, "wb") as out:
+        out.write(LOG_HEADER_LINE)
+        d = start_date
+        while d <= end_date:
+            f = LOG_DIR / f"{d.isoformat()}.csv"
+            if f.exists():
+                with open(f, "rb") as src:
+                    first = src.readline()
+                    if first.rstrip(b"\r\n") == LOG_HEADER_LINE.rstrip(b"\r\n"):
+                        last = b""
+                        for chunk in iter(lambda: src.read(65536), b""):
+                            out.write(chunk)
+                            rows += chunk.count(b"\n")
+                            last = chunk[-1:]
+                        if last and last != b"\n":
+                            # unterminated last row: end it so the next file's rows don't join it
+                            out.write(b"\r\n")
+                            rows += 1
+                    else:
+                        src.seek(0)
+                        r = csv.reader(io.TextIOWrapper(src, newline=""))
+                        _ = next(r, None)
+                        body = list(r)
+                        buf = io.StringIO()
+                        csv.writer(buf).writerows(body)
+                        out.write(buf.getvalue().encode())
+                        rows += len(body)
+            d += timedelta(days=1)
+    print(f"[LOG] Combined {rows} rows -> {output_file.name}")
+
+def get_candle_color(candle_start: datetime, now_server: Optional[datetime] = None):
+    rates = None
+    if now_server is not None:
+        # position-indexed fetch is cheaper than the dated one; only trusted if the
+        # bar at that position really opened at candle_start (no gaps in between)
+        current_bar = now_server.replace(second=0, microsecond=0) - timedelta(minutes=now_server.minute % 5)
+        pos = int((current_bar - candle_start).total_seconds() // 300)
+        if pos >= 0:
+            rates = mt5.copy_rates_from_pos(SYMBOL, mt5.TIMEFRAME_M5, pos, 1)
+            if rates is not None and len(rates) and datetime.fromtimestamp(int(rates[0]["time"])) != candle_start:
+                rates = None
+    if rates is None or len(rates) == 0:
+        rates = mt5.copy_rates_from(SYMBOL, mt5.TIMEFRAME_M5, candle_start, 1)
     if rates is None or len(rates) == 0:
         return None
     o, c = rates[0]["open"], rates[0]["close"]
@@ -153,30 +233,29 @@ def margin_ok(order_type, volume, price) -> bool:
         acc = mt5.account_info()
         ok = (mr is not None) and (acc is not None) and (mr <= acc.margin_free)
         if not ok:
-            print(f"[MARGIN] Need {mr}, free {acc.margin_free} -> skip")
+            _log(f"[MARGIN] Need {mr}, free {getattr(acc, 'margin_free', None)} -> skip")
         return ok
     except Exception as e:
-        print(f"[MARGIN] check error: {e}")
+        _log(f"[MARGIN] check error: {e}")
         return False
 
 def place_trade(signal: str, volume: float, tag: str):
+    """Returns (result, entry_price, sl, tp); result is None if no order was sent."""
     tick = mt5.symbol_info_tick(SYMBOL)
     if not tick:
-        print("[TRADE] No tick data.")
-        return None
+        _log("[TRADE] No tick data.")
+        return None, None, None, None
     price = tick.ask if signal == "BUY" else tick.bid
-    sl_distance = SL_PIPS * PIP_SIZE
-    tp_distance = TP_PIPS * PIP_SIZE
     if signal == "BUY":
-        sl = price - sl_distance
-        tp = price + tp_distance
+        sl = price - _SL_DIST
+        tp = price + _TP_DIST
         order_type = mt5.ORDER_TYPE_BUY
     else:
-        sl = price + sl_distance
-        tp = price - tp_distance
+        sl = price + _SL_DIST
+        tp = price - _TP_DIST
         order_type = mt5.ORDER_TYPE_SELL
     if not margin_ok(order_type, volume, price):
-        return None
+        return None, price, sl, tp
     req = {
         "action": mt5.TRADE_ACTION_DEAL,
         "symbol": SYMBOL,
@@ -192,21 +271,41 @@ def place_trade(signal: str, volume: float, tag: str):
         "type_filling": mt5.ORDER_FILLING_FOK
     }
     result = mt5.order_send(req)
-    print(f"[TRADE] {signal} vol={volume:.2f} price={price:.3f} SL={sl:.3f} TP={tp:.3f} -> ret={result.retcode}, comment={getattr(res,'comment','') if (res:=result) else ''}")
-    return result
-
-def log_row_for_day(day: date, row):
-    file = LOG_DIR / f"{day.isoformat()}.csv"
-    write_header = not file.exists()
-    with open(file, "a", newline="") as f:
-        w = csv.writer(f)
-        if write_header:
-            w.writerow(["Date","Time","Signal","Volume","Entry","SL","TP","Result","Profit","Balance"])
-        w.writerow(row)
+    ret = result.retcode if result else None
+    comment = getattr(result, "comment", "") if result else ""
+    _log(f"[TRADE] {signal} vol={volume:.2f} price={price:.3f} SL={sl:.3f} TP={tp:.3f} -> ret={ret}, comment={comment}")
+    return result, price, sl, tp
+
+# Current day's CSV stays open (one FD per day); each row is flushed for durability
+_DAY_LOG = {"date": None, "fp": None, "lock": threading.Lock()}
+
+def _close_day_log():
+    with _DAY_LOG["lock"]:
+        if _DAY_LOG["fp"] is not None:
+            _DAY_LOG["fp"].close()
+        _DAY_LOG.update(date=None, fp=None)
+
+atexit.register(_close_day_log)
+
+def log_row_for_day(day: date, line: str):
+    data = line.encode()
+    with _DAY_LOG["lock"]:
+        if day != _DAY_LOG["date"]:
+            if _DAY_LOG["fp"] is not None:
+                _DAY_LOG["fp"].close()
+            file = LOG_DIR / f"{day.isoformat()}.csv"
+            write_header = not file.exists()
+            fp = open(file, "ab", buffering=8192)
+            if write_header:
+                fp.write(LOG_HEADER_LINE)
+            _DAY_LOG.update(date=day, fp=fp)
+        _DAY_LOG["fp"].write(data)
+        _DAY_LOG["fp"].flush()
 
 # ====== DAILY REALIZED P/L TRACKER (thread-safe) ======
-DAILY_REALIZED_PNL = 0.0
-DAILY_REALIZED_LOCK = threading.Lock()
+# Watchers append closed-trade P/L; readers sum it. list.append/clear are atomic
+# under the GIL, so no lock is needed.
+_PNL_DELTAS: List[float] = []
 
 def watcher_for_trade(trade_tag: str, approx_time: datetime, expected_signal: str, volume: float, entry: float, sl: float, tp: float, position_ticket: Optional[int] = None):
     pos_ticket = position_ticket
@@ -232,11 +331,11 @@ def watcher_for_trade(trade_tag: str, approx_time: datetime, expected_signal: st
             time.sleep(0.5)
 
     if pos_ticket:
-        while True:
-            positions = mt5.positions_get(symbol=SYMBOL)
-            if not any(p.ticket == pos_ticket for p in positions or []):
-                break
-            time.sleep(0.5)
+        # TP/SL rarely hit in the first seconds: back off 0.5s -> 5s between checks
+        attempts = 0
+        while mt5.positions_get(ticket=pos_ticket):
+            time.sleep(min(5.0, 0.5 * (1.5 ** attempts)))
+            attempts = min(attempts + 1, 6)  # 0.5 * 1.5**6 > 5.0; keeps the power bounded
 
     start_hist = approx_time - timedelta(hours=6)
     end_hist = datetime.now(timezone.utc).astimezone().replace(tzinfo=None) + timedelta(minutes=10)
@@ -264,25 +363,15 @@ def watcher_for_trade(trade_tag: str, approx_time: datetime, expected_signal: st
     acc = mt5.account_info()
     balance_after = getattr(acc, "balance", 0.0)
 
-    global DAILY_REALIZED_PNL
-    with DAILY_REALIZED_LOCK:
-        DAILY_REALIZED_PNL += float(profit)
+    _PNL_DELTAS.append(float(profit))
 
     open_day = approx_time.date()
-    row = [
-        open_day.isoformat(),
-        approx_time.strftime("%H:%M"),
-        expected_signal,
-        f"{volume:.2f}",
-        f"{entry:.3f}",
-        f"{sl:.3f}",
-        f"{tp:.3f}",
-        result_text,
-        f"{profit:.2f}",
-        f"{balance_after:.2f}",
-    ]
-    log_row_for_day(open_day, row)
-    print(f"[LOG] {result_text} profit={profit:.2f} logged for {trade_tag}")
+    line = _ROW_FMT.format(
+        date=open_day.isoformat(), time=approx_time.strftime("%H:%M"), sig=expected_signal,
+        vol=volume, entry=entry, sl=sl, tp=tp, res=result_text, pnl=profit, bal=balance_after,
+    )
+    log_row_for_day(open_day, line)
+    _log(f"[LOG] {result_text} profit={profit:.2f} logged for {trade_tag}")
 
 # --- One-time send helpers (in-memory + atomic file sentinels) ---
 def _sentinel_path(kind: str, key: str) -> Path:
@@ -294,99 +383,121 @@ def _already_sent(kind: str, key: str) -> bool:
 def _mark_sent_atomic(kind: str, key: str) -> bool:
     p = _sentinel_path(kind, key)
     try:
-        fd = os.open(p, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
-        with os.fdopen(fd, "w") as f:
-            f.write(f"sent at {datetime.now(timezone.utc).isoformat()}\n")
-        return True
+        p.touch(exist_ok=False)  # O_CREAT|O_EXCL: exactly one caller wins
     except FileExistsError:
         return False
-    except Exception:
-        try:
-            if not p.exists():
-                with open(p, "w") as f:
-                    f.write(f"sent at {datetime.now(timezone.utc).isoformat()}\n")
-                return True
-        except Exception:
-            pass
-        return p.exists()
+    p.write_text(f"sent at {datetime.now(timezone.utc).isoformat()}\n")
+    return True
 
 EOD_SENT_DAYS       = set()
 WEEKLY_SENT_KEYS    = set()
 MONTHLY_SENT_KEYS   = set()
+_EMAIL_RETRY = {"at": 0.0}     # monotonic time before which a failed delivery is not retried
 
 def run_email_end_of_day_if_last_trade_closed(today: date):
-    if today in EOD_SENT_DAYS:
+    if today in EOD_SENT_DAYS or time.monotonic() < _EMAIL_RETRY["at"]:
         return
 
+    now = datetime.now()
+    daily_key = today.isoformat()
+    weekly_key = now.date().isoformat() if now.weekday() == 5 else None
+    monthly_key = f"{now.year}-{now.month:02d}" if is_last_day_of_month(now) else None
+
+    # Sentinel stats are cheaper than the positions IPC: if every report due today
+    # is already out (e.g. after a restart), stop here
+    if _already_sent("daily", daily_key):
+        weekly_done = weekly_key is None or weekly_key in WEEKLY_SENT_KEYS or _already_sent("weekly", weekly_key)
+        monthly_done = monthly_key is None or monthly_key in MONTHLY_SENT_KEYS or _already_sent("monthly", monthly_key)
+        if weekly_done and monthly_done:
+            EOD_SENT_DAYS.add(today)
+            return
+
     open_positions = mt5.positions_get(symbol=SYMBOL)
     if open_positions and any(getattr(p, "magic", 0) == MAGIC for p in open_positions):
         return
 
-    now = datetime.now()
+    # Combining and sending can fail (I/O, SMTP). The error is logged rather than
+    # raised so the bot keeps trading, and whatever was not sent is retried after
+    # EMAIL_RETRY_SECONDS. A sentinel is only kept once its own report went out.
+    try:
+        due = []  # (kind, key, subject, body, filepath)
+
+        # DAILY
+        daily_file = LOG_DIR / f"{daily_key}.csv"
+        if daily_file.exists() and not _already_sent("daily", daily_key):
+            due.append(("daily", daily_key, f"Daily Trading Log — {daily_key}",
+                        "Attached is today's trading log.", daily_file))
+
+        # WEEKLY (Saturday)
+        if weekly_key is not None and weekly_key not in WEEKLY_SENT_KEYS and not _already_sent("weekly", weekly_key):
+            start = (now - timedelta(days=6)).date()
+            end = now.date()
+            weekly_file = LOG_DIR / f"weekly_{weekly_key}.csv"
+            combine_logs(weekly_file, start, end)
+            due.append(("weekly", weekly_key, f"Weekly Trading Log — week ending {weekly_key}",
+                        f"Attached trading log for {start.isoformat()} to {weekly_key}.", weekly_file))
+
+        # MONTHLY
+        if monthly_key is not None and monthly_key not in MONTHLY_SENT_KEYS and not _already_sent("monthly", monthly_key):
+            m = now.month; y = now.year
+            start_month = date(y, m, 1)
+            end_month = now.date()
+            monthly_file = LOG_DIR / f"monthly_{monthly_key}.csv"
+            combine_logs(monthly_file, start_month, end_month)
+            due.append(("monthly", monthly_key, f"Monthly Trading Log — {monthly_key}",
+                        f"Attached trading log for {monthly_key}.", monthly_file))
+
+        if due:
+            with smtp_session() as server:
+                for kind, key, subject, body, filepath in due:
+                    if not _mark_sent_atomic(kind, key):
+                        continue  # already claimed elsewhere
+                    try:
+                        _send_via(server, subject, body, filepath)
+                    except Exception:
+                        _sentinel_path(kind, key).unlink(missing_ok=True)  # release for retry
+                        raise
+    except Exception as e:
+        _EMAIL_RETRY["at"] = time.monotonic() + EMAIL_RETRY_SECONDS
+        print(f"[EMAIL] Report delivery failed: {e} (retrying in {EMAIL_RETRY_SECONDS}s)")
+        return
 
-    # DAILY
-    daily_key = today.isoformat()
-    daily_file = LOG_DIR / f"{daily_key}.csv"
     if daily_file.exists():
-        if not _already_sent("daily", daily_key):
-            if _mark_sent_atomic("daily", daily_key):
-                send_email(f"Daily Trading Log — {daily_key}", "Attached is today's trading log.", daily_file)
         EOD_SENT_DAYS.add(today)
-
-    # WEEKLY (Saturday)
-    if now.weekday() == 5:
-        start = (now - timedelta(days=6)).date()
-        end = now.date()
-        weekly_key = end.isoformat()
-        if weekly_key not in WEEKLY_SENT_KEYS:
-            if not _already_sent("weekly", weekly_key):
-                if _mark_sent_atomic("weekly", weekly_key):
-                    weekly_file = LOG_DIR / f"weekly_{weekly_key}.csv"
-                    combine_logs(weekly_file, start, end)
-                    send_email(f"Weekly Trading Log — week ending {weekly_key}",
-                               f"Attached trading log for {start.isoformat()} to {weekly_key}.",
-                               weekly_file)
-            WEEKLY_SENT_KEYS.add(weekly_key)
-
-    # MONTHLY
-    def is_last_day_of_month_local(dt: datetime) -> bool:
-        return (dt + timedelta(days=1)).month != dt.month
-    if is_last_day_of_month_local(now):
-        m = now.month; y = now.year
-        monthly_key = f"{y}-{m:02d}"
-        if monthly_key not in MONTHLY_SENT_KEYS:
-            if not _already_sent("monthly", monthly_key):
-                if _mark_sent_atomic("monthly", monthly_key):
-                    start_month = date(y, m, 1)
-                    end_month = now.date()
-                    monthly_file = LOG_DIR / f"monthly_{monthly_key}.csv"
-                    combine_logs(monthly_file, start_month, end_month)
-                    send_email(f"Monthly Trading Log — {monthly_key}",
-                               f"Attached trading log for {monthly_key}.",
-                               monthly_file)
-            MONTHLY_SENT_KEYS.add(monthly_key)
+    if weekly_key is not None:
+        WEEKLY_SENT_KEYS.add(weekly_key)
+    if monthly_key is not None:
+        MONTHLY_SENT_KEYS.add(monthly_key)
 
 # ==== Re-anchor helpers & symbol meta ====
-def symbol_meta():
+# (info, point, digits, stops_level) — static per symbol, so fetched once and reused
+_SYMBOL_META_CACHE: Optional[Tuple] = None
+
+def refresh_symbol_meta():
+    global _SYMBOL_META_CACHE
     info = mt5.symbol_info(SYMBOL)
     if info is None:
         raise RuntimeError(f"symbol_info failed for {SYMBOL}")
     stops_level = getattr(info, "trade_stops_level", 0)
-    return info, info.point, info.digits, stops_level
+    _SYMBOL_META_CACHE = (info, info.point, info.digits, stops_level)
+    return _SYMBOL_META_CACHE
+
+def symbol_meta():
+    if _SYMBOL_META_CACHE is None:
+        return refresh_symbol_meta()
+    return _SYMBOL_META_CACHE
 
 def normalize_price(price: float) -> float:
     info, point, digits, _ = symbol_meta()
     return round(price, digits)
 
 def compute_sl_tp_from(entry: float, side: str):
-    sl_dist = SL_PIPS * PIP_SIZE
-    tp_dist = TP_PIPS * PIP_SIZE
     if side == "BUY":
-        sl = entry - sl_dist
-        tp = entry + tp_dist
+        sl = entry - _SL_DIST
+        tp = entry + _TP_DIST
     else:
-        sl = entry + sl_dist
-        tp = entry - tp_dist
+        sl = entry + _SL_DIST
+        tp = entry - _TP_DIST
     return normalize_price(sl), normalize_price(tp)
 
 def enforce_min_distance(entry: float, sl: float, tp: float, side: str):
@@ -409,6 +520,12 @@ def enforce_min_distance(entry: float, sl: float, tp: float, side: str):
 def get_position_ticket_from_deal(deal_ticket: int, opened_at: datetime) -> Optional[int]:
     if not deal_ticket:
         return None
+    deals = mt5.history_deals_get(ticket=deal_ticket)
+    if deals:
+        pid = int(getattr(deals[0], "position_id", 0))
+        if pid:
+            return pid
+    # fallback: scan the time window around the open
     start = opened_at - timedelta(minutes=30)
     end   = opened_at + timedelta(minutes=30)
     deals = mt5.history_deals_get(start, end)
@@ -420,9 +537,10 @@ def get_position_ticket_from_deal(deal_ticket: int, opened_at: datetime) -> Opti
             return pid or None
     return None
 
-def reanchor_sl_tp_by_position(position_ticket: int, side: str):
+def reanchor_sl_tp_by_position(position_ticket: int, side: str) -> Optional[Tuple[float, float, float]]:
+    """Returns the position's (entry, sl, tp) after re-anchoring, or None if it was not found."""
     if not position_ticket:
-        return
+        return None
     pos_list = mt5.positions_get(symbol=SYMBOL)
     pos = None
     if pos_list:
@@ -431,8 +549,8 @@ def reanchor_sl_tp_by_position(position_ticket: int, side: str):
                 pos = p
                 break
     if not pos:
-        print(f"[REANCHOR] Position {position_ticket} not found (skip).")
-        return
+        _log(f"[REANCHOR] Position {position_ticket} not found (skip).")
+        return None
     entry = float(pos.price_open)
     new_sl, new_tp = compute_sl_tp_from(entry, side)
     new_sl, new_tp = enforce_min_distance(entry, new_sl, new_tp, side)
@@ -440,8 +558,8 @@ def reanchor_sl_tp_by_position(position_ticket: int, side: str):
     diff_sl = abs((pos.sl or 0.0) - new_sl)
     diff_tp = abs((pos.tp or 0.0) - new_tp)
     if diff_sl < point and diff_tp < point:
-        print(f"[REANCHOR] No change needed (SL/TP already aligned).")
-        return
+        _log("[REANCHOR] No change needed (SL/TP already aligned).")
+        return entry, new_sl, new_tp
     req = {
         "action":   mt5.TRADE_ACTION_SLTP,
         "symbol":   SYMBOL,
@@ -452,23 +570,31 @@ def reanchor_sl_tp_by_position(position_ticket: int, side: str):
         "comment":  f"reanchor|{position_ticket}",
     }
     res = mt5.order_send(req)
-    print(f"[REANCHOR] Modify SL/TP -> ret={res.retcode}, sl={new_sl:.3f}, tp={new_tp:.3f}")
+    _log(f"[REANCHOR] Modify SL/TP -> ret={getattr(res,'retcode',None)}, sl={new_sl:.3f}, tp={new_tp:.3f}")
+    if res and res.retcode == mt5.TRADE_RETCODE_DONE:
+        return entry, new_sl, new_tp
+    return entry, float(pos.sl or 0.0), float(pos.tp or 0.0)
 
 # ==== Lot sizing (QuantTekel DD-based) ====
-def dollars_per_1usd_move_for_1lot() -> float:
+def dollars_per_1usd_move_for_1lot() -> Optional[float]:
+    """$ per 1.0 price move for 1 lot from order_calc_profit, or None if MT5 could not say."""
     tick = mt5.symbol_info_tick(SYMBOL)
     if not tick:
-        return 100.0
+        return None
     ref = tick.bid or tick.ask or 0.0
     try:
         pr = mt5.order_calc_profit(mt5.ORDER_TYPE_BUY, SYMBOL, 1.0, ref, ref + 1.0)
         if pr is None:
-            return 100.0
+            return None
         return abs(float(pr))
     except Exception:
-        return 100.0
+        return None
 
-def lot_size_quanntekel() -> float:
+# $ per 1.0 price move for 1 lot is effectively constant intraday: one real
+# order_calc_profit value is kept per server day (the 100.0 fallback never is)
+_PER_LOT_CACHE = {"day": None, "val": None}
+
+def lot_size_quanntekel(server_day: Optional[date] = None) -> float:
     """
     DD-based sizing:
     - Base 'virtual balance' is today's DD budget (e.g., 37.5 USD), optionally adjusted by realized P/L.
@@ -478,18 +604,22 @@ def lot_size_quanntekel() -> float:
     """
     vb = DAILY_DD_USD
     if USE_DYNAMIC_VB:
-        with DAILY_REALIZED_LOCK:
-            vb += float(DAILY_REALIZED_PNL)
+        vb += math.fsum(_PNL_DELTAS)
     vb = max(vb, 0.0)
 
     steps = int(vb // 100)       # 0 for < $100, grows every +$100 of available DD
     lots = round(steps * 0.02, 2)
 
     # risk cap by DD
-    per_dollar_1lot = dollars_per_1usd_move_for_1lot()
-    sl_usd_move = SL_PIPS * PIP_SIZE
+    if _PER_LOT_CACHE["day"] != server_day or _PER_LOT_CACHE["val"] is None:
+        val = dollars_per_1usd_move_for_1lot()
+        if val is not None:
+            _PER_LOT_CACHE.update(day=server_day, val=val)
+        per_dollar_1lot = 100.0 if val is None else val
+    else:
+        per_dollar_1lot = _PER_LOT_CACHE["val"]
     if per_dollar_1lot > 0:
-        max_lots_by_dd = DAILY_DD_USD / (per_dollar_1lot * sl_usd_move)
+        max_lots_by_dd = DAILY_DD_USD / (per_dollar_1lot * _SL_DIST)
         if lots > max_lots_by_dd:
             lots = max(0.01, round(max_lots_by_dd - 1e-9, 2))
 
@@ -508,6 +638,8 @@ def _ist_to_server_delta_minutes_for_date(d: date) -> int:
     ist_gmt = 5.5
     return int(round((server_gmt - ist_gmt) * 60))
 
+_HHMM_RE = re.compile(r'^(\d{1,2}):(\d{1,2})(?::\d{1,2})?$')
+
 def _parse_hhmm(hhmm: str):
     """
     Accepts 'HH:MM' or 'HH:MM:SS' (also tolerates trailing spaces/comments).
@@ -515,7 +647,7 @@ def _parse_hhmm(hhmm: str):
     """
     s = str(hhmm).strip()
     s = s.split()[0]  # only the first token
-    m = re.match(r'^(\d{1,2}):(\d{1,2})(?::\d{1,2})?$', s)
+    m = _HHMM_RE.match(s)
     if not m:
         raise ValueError(f"Bad time format in IST_TRADE_TIMES: {hhmm!r} (expected HH:MM or HH:MM:SS)")
     h = int(m.group(1)); mnt = int(m.group(2))
@@ -523,65 +655,109 @@ def _parse_hhmm(hhmm: str):
         raise ValueError(f"Out-of-range time in IST_TRADE_TIMES: {hhmm!r}")
     return h, mnt
 
+# IST_TRADE_TIMES parsed once at import as (hour, minute) pairs
+_IST_TRADE_HM = tuple(_parse_hhmm(t) for t in IST_TRADE_TIMES)
+
 def build_server_schedule_for_day(ist_day: date) -> Tuple[dict, int]:
     delta_min = _ist_to_server_delta_minutes_for_date(ist_day)
     delta = timedelta(minutes=delta_min)
     sched = {}
-    for tstr in IST_TRADE_TIMES:
-        hh, mm = _parse_hhmm(tstr)
+    for hh, mm in _IST_TRADE_HM:
         ist_dt = datetime.combine(ist_day, dt_time(hh, mm, tzinfo=IST_TZ))
         server_dt = (ist_dt + delta).replace(tzinfo=None)  # naive server time
         sched[f"{hh:02d}:{mm:02d}"] = server_dt  # normalized key
     return sched, delta_min
 
-def _next_slot_info_server(now_server: datetime, today_server_sched: dict, executed_ist: set) -> Tuple[Optional[str], Optional[int]]:
-    for ist_hhmm, server_dt in today_server_sched.items():
-        if ist_hhmm in executed_ist:
-            continue
-        if now_server <= server_dt:
-            return ist_hhmm, int((server_dt - now_server).total_seconds())
-    return None, None
-
 def _measured_delta_minutes(now_server: datetime, now_ist: datetime) -> int:
-    s = datetime(2000,1,1, now_server.hour, now_server.minute, now_server.second)
-    i = datetime(2000,1,1, now_ist.hour,   now_ist.minute,   now_ist.second)
-    return int(round((s - i).total_seconds() / 60.0))
-
-def _heartbeat_line(now_server: datetime, today_server_sched: dict, executed_ist: set, configured_delta_min: int) -> str:
-    now_utc = datetime.now(timezone.utc)
-    now_ist = now_utc.astimezone(IST_TZ)
-    next_ist, secs = _next_slot_info_server(now_server, today_server_sched, executed_ist)
-    fired = len(executed_ist)
+    s = now_server.hour * 3600 + now_server.minute * 60 + now_server.second
+    i = now_ist.hour * 3600 + now_ist.minute * 60 + now_ist.second
+    # +30s rounds to the nearest minute; the modulo wraps across midnight into [-720, 720)
+    return (s - i + 43200 + 30) % 86400 // 60 - 720
+
+def _heartbeat_line(now_server: datetime, now_ist: datetime, next_slot: Optional[Tuple[datetime, str]],
+                    fired: int, configured_delta_min: int, fire_labels: dict) -> str:
     total = len(IST_TRADE_TIMES)
     meas_delta = _measured_delta_minutes(now_server, now_ist)
     sign = "+" if meas_delta >= 0 else "-"
-    if next_ist is None:
+    if next_slot is None:
         tail = "no more IST slots today"
     else:
+        server_dt, next_ist = next_slot
+        secs = max(0, int((server_dt - now_server).total_seconds()))
         hh = secs // 3600
         mm = (secs % 3600) // 60
         ss = secs % 60
-        server_dt = today_server_sched[next_ist]
-        tail = f"next IST {next_ist} -> fires at server {server_dt.strftime('%H:%M:%S')} in {hh:02d}:{mm:02d}:{ss:02d}"
+        tail = f"next IST {next_ist} -> fires at server {fire_labels[next_ist]} in {hh:02d}:{mm:02d}:{ss:02d}"
     return (f"[HB] server {now_server.strftime('%Y-%m-%d %H:%M:%S')} | IST {now_ist.strftime('%Y-%m-%d %H:%M:%S')} "
             f"| server-IST delta {sign}{abs(meas_delta)}m (cfg {configured_delta_min:+}m) | slots {fired}/{total} | {tail}")
 
+# A stalled terminal must not hold up the main loop: ticks are fetched on a worker
+# and, past TICK_TIMEOUT_SECONDS, server time is extrapolated from the last tick.
+# The worker is a daemon thread so a call stuck in the terminal cannot delay exit.
+_TICK_REQS: queue.Queue = queue.Queue()
+_TICK_STATE = {"fut": None, "tick_time": None, "wall": None, "worker": None}
+
+def _tick_worker():
+    while True:
+        fut = _TICK_REQS.get()
+        try:
+            fut.set_result((mt5.symbol_info_tick(SYMBOL), time.monotonic()))
+        except Exception as e:
+            fut.set_exception(e)
+
+def _submit_tick_fetch() -> Future:
+    if _TICK_STATE["worker"] is None:
+        _TICK_STATE["worker"] = threading.Thread(target=_tick_worker, daemon=True)
+        _TICK_STATE["worker"].start()
+    fut = Future()
+    _TICK_REQS.put(fut)
+    return fut
+
+def _server_now() -> datetime:
+    fut = _TICK_STATE["fut"]
+    if fut is None:
+        fut = _TICK_STATE["fut"] = _submit_tick_fetch()
+    try:
+        tick, fetched_at = fut.result(timeout=TICK_TIMEOUT_SECONDS)
+    except FuturesTimeout:
+        # leave it pending so the next call waits on it instead of queueing another
+        tick = None
+    except Exception:
+        _TICK_STATE["fut"] = None
+        return datetime.now()
+    else:
+        _TICK_STATE["fut"] = None
+        if not tick:
+            return datetime.now()
+        _TICK_STATE["tick_time"] = tick.time
+        _TICK_STATE["wall"] = fetched_at
+    if _TICK_STATE["tick_time"] is None:
+        return datetime.now()
+    return datetime.fromtimestamp(_TICK_STATE["tick_time"] + (time.monotonic() - _TICK_STATE["wall"]))
+
 # ==========================
 
 def main():
     init_mt5()
     print("[INIT] MT5 initialized and logged in.")
+    if HEARTBEAT_EVERY_SEC and HEARTBEAT_SINGLE_LINE and hasattr(sys.stdout, "reconfigure"):
+        # a line-buffered console would flush on every "\r"; the heartbeat loop
+        # flushes every HEARTBEAT_FLUSH_SECONDS or on a new minute instead
+        sys.stdout.reconfigure(line_buffering=False)
 
-    executed_ist_today = set()
     current_server_day = None
     today_server_sched = {}
+    pending_slots = []   # min-heap of (server_dt, ist_hhmm) not yet fired/expired
+    fire_labels = {}     # ist_hhmm -> server fire time as HH:MM:SS (rendered once per day)
     delta_min = 0
     watcher_threads = []
+    last_hb_flush = (0.0, None)  # (monotonic time, server minute) of the last stdout flush
+    log_thread = threading.Thread(target=_log_drain, daemon=True)
+    log_thread.start()
 
     try:
         while True:
-            tick = mt5.symbol_info_tick(SYMBOL)
-            now_server = datetime.fromtimestamp(tick.time) if tick else datetime.now()
+            now_server = _server_now()
             server_day = now_server.date()
 
             now_utc = datetime.now(timezone.utc)
@@ -589,12 +765,16 @@ def main():
             ist_day = now_ist.date()
 
             if server_day != current_server_day:
-                executed_ist_today.clear()
                 current_server_day = server_day
+                try:
+                    refresh_symbol_meta()
+                except RuntimeError as e:
+                    print(f"[META] {e} (keeping cached symbol meta)")
                 today_server_sched, delta_min = build_server_schedule_for_day(ist_day)
-                global DAILY_REALIZED_PNL
-                with DAILY_REALIZED_LOCK:
-                    DAILY_REALIZED_PNL = 0.0
+                pending_slots = [(sdt, ist_hhmm) for ist_hhmm, sdt in today_server_sched.items()]
+                heapq.heapify(pending_slots)
+                fire_labels = {ist_hhmm: sdt.strftime('%H:%M:%S') for ist_hhmm, sdt in today_server_sched.items()}
+                _PNL_DELTAS.clear()
 
                 print(f"\n--- New (server) day {server_day} / IST day {ist_day} ---")
                 print(f"[TZ] Using server-IST delta = {delta_min:+} minutes "
@@ -602,80 +782,90 @@ def main():
                 for ist_hhmm, sdt in today_server_sched.items():
                     print(f"[SCHEDULE] IST {ist_hhmm} -> server {sdt.strftime('%H:%M')}")
 
+            # Slots whose fire window has already passed are dropped without trading
+            while pending_slots and (now_server - pending_slots[0][0]).total_seconds() > FIRE_WINDOW_SECONDS:
+                heapq.heappop(pending_slots)
+
             if HEARTBEAT_EVERY_SEC:
-                hb = _heartbeat_line(now_server, today_server_sched, executed_ist_today, delta_min)
+                upcoming = pending_slots[0] if pending_slots else None
+                fired = len(today_server_sched) - len(pending_slots)
+                hb = _heartbeat_line(now_server, now_ist, upcoming, fired, delta_min, fire_labels)
                 if HEARTBEAT_SINGLE_LINE:
-                    print(hb.ljust(130), end="\r", flush=True)
+                    sys.stdout.write(f"{hb:<130}\r")
+                    mono = time.monotonic()
+                    if mono - last_hb_flush[0] >= HEARTBEAT_FLUSH_SECONDS or now_server.minute != last_hb_flush[1]:
+                        sys.stdout.flush()
+                        last_hb_flush = (mono, now_server.minute)
                 else:
                     print(hb, flush=True)
 
-            for ist_hhmm, fire_dt_server in list(today_server_sched.items()):
-                if ist_hhmm in executed_ist_today:
+            while pending_slots and abs((now_server - pending_slots[0][0]).total_seconds()) <= FIRE_WINDOW_SECONDS:
+                fire_dt_server, ist_hhmm = heapq.heappop(pending_slots)
+
+                candle_start = (fire_dt_server - timedelta(minutes=5)).replace(second=0, microsecond=0)
+                colour = get_candle_color(candle_start, now_server)
+                if not colour:
+                    _log(f"[SKIP] No candle at {candle_start} for IST slot {ist_hhmm}")
                     continue
-                lag = (now_server - fire_dt_server).total_seconds()
-                if abs(lag) <= FIRE_WINDOW_SECONDS:
-                    candle_start = (fire_dt_server - timedelta(minutes=5)).replace(second=0, microsecond=0)
-                    colour = get_candle_color(candle_start)
-                    if not colour:
-                        print(f"[SKIP] No candle at {candle_start} for IST slot {ist_hhmm}")
-                        executed_ist_today.add(ist_hhmm)
-                        continue
 
-                    signal = "BUY" if colour == "Green" else "SELL"
-                    acc = mt5.account_info()
-                    if LOT_MODE == "quanttekel":
-                        vol = lot_size_quanntekel()
-                    elif LOT_MODE == "balance":
-                        vol = lot_size_balance(acc.balance if acc else 100.0)
-                    else:
-                        vol = lot_size_quanntekel()  # default to DD-based
+                signal = "BUY" if colour == "Green" else "SELL"
+                acc = mt5.account_info()
+                if LOT_MODE == "quanttekel":
+                    vol = lot_size_quanntekel(server_day)
+                elif LOT_MODE == "balance":
+                    vol = lot_size_balance(acc.balance if acc else 100.0)
+                else:
+                    vol = lot_size_quanntekel(server_day)  # default to DD-based
 
-                    tag = f"{ist_day.isoformat()}_{ist_hhmm}"
-                    print(f"[SIGNAL] IST {ist_hhmm} (server {fire_dt_server.strftime('%H:%M')}) prev={colour} -> {signal}, vol={vol:.2f}")
-                    res = place_trade(signal, vol, tag)
-                    executed_ist_today.add(ist_hhmm)
+                tag = f"{ist_day.isoformat()}_{ist_hhmm}"
+                _log(f"[SIGNAL] IST {ist_hhmm} (server {fire_dt_server.strftime('%H:%M')}) prev={colour} -> {signal}, vol={vol:.2f}")
+                res, price, sl, tp = place_trade(signal, vol, tag)
 
-                    if res and res.retcode == mt5.TRADE_RETCODE_DONE:
+                if res and res.retcode == mt5.TRADE_RETCODE_DONE:
+                    pos_ticket = None
+                    try:
+                        pos_ticket = get_position_ticket_from_deal(int(getattr(res, "deal", 0)), now_server)
+                    except Exception:
                         pos_ticket = None
-                        try:
-                            pos_ticket = get_position_ticket_from_deal(int(getattr(res, "deal", 0)), now_server)
-                        except Exception:
-                            pos_ticket = None
-                        if pos_ticket:
-                            reanchor_sl_tp_by_position(pos_ticket, signal)
-                        else:
-                            print("[REANCHOR] Could not resolve position ticket from deal (skip re-anchor).")
-
-                        tick2 = mt5.symbol_info_tick(SYMBOL)
-                        price = tick2.ask if signal=="BUY" else tick2.bid
-                        sl = price - SL_PIPS*PIP_SIZE if signal=="BUY" else price + SL_PIPS*PIP_SIZE
-                        tp = price + TP_PIPS*PIP_SIZE if signal=="BUY" else price - TP_PIPS*PIP_SIZE
-
-                        t_thr = threading.Thread(
-                            target=watcher_for_trade,
-                            args=(f"50pip_bot|{tag}", fire_dt_server.replace(second=0, microsecond=0), signal, vol, price, sl, tp, pos_ticket),
-                            daemon=True
-                        )
-                        t_thr.start()
-                        watcher_threads.append(t_thr)
+                    if pos_ticket:
+                        anchored = reanchor_sl_tp_by_position(pos_ticket, signal)
+                        if anchored:
+                            price, sl, tp = anchored  # actual fill and the levels now on the position
                     else:
-                        print(f"[TRADE] Order not executed (ret={getattr(res,'retcode',None)})")
-
-                elif lag > FIRE_WINDOW_SECONDS:
-                    executed_ist_today.add(ist_hhmm)
+                        _log("[REANCHOR] Could not resolve position ticket from deal (skip re-anchor).")
+
+                    t_thr = threading.Thread(
+                        target=watcher_for_trade,
+                        args=(f"50pip_bot|{tag}", fire_dt_server.replace(second=0, microsecond=0), signal, vol, price, sl, tp, pos_ticket),
+                        daemon=True
+                    )
+                    t_thr.start()
+                    watcher_threads.append(t_thr)
+                else:
+                    _log(f"[TRADE] Order not executed (ret={getattr(res,'retcode',None)})")
 
-            if len(executed_ist_today) == len(IST_TRADE_TIMES):
+            if not pending_slots:
                 run_email_end_of_day_if_last_trade_closed(server_day)
 
-            time.sleep(1)
+            # Sleep until the next slot's fire window opens; the heartbeat keeps
+            # a 1s cadence, otherwise wake at least every IDLE_POLL_SECONDS.
+            if pending_slots:
+                sleep_s = (pending_slots[0][0] - now_server).total_seconds() - FIRE_WINDOW_SECONDS
+            else:
+                sleep_s = IDLE_POLL_SECONDS
+            sleep_s = min(max(0.0, sleep_s), 1.0 if HEARTBEAT_EVERY_SEC else IDLE_POLL_SECONDS)
+            time.sleep(sleep_s)
     except KeyboardInterrupt:
         print("\nBot interrupted by user.")
     finally:
         if HEARTBEAT_EVERY_SEC and HEARTBEAT_SINGLE_LINE:
-            print()
+            print(flush=True)
         for t in watcher_threads:
             if t.is_alive():
                 t.join(timeout=2.0)
+        # watchers may have queued their [LOG] lines above; drain them, but never block shutdown on it
+        _LOG_Q.put(_LOG_STOP)
+        log_thread.join(timeout=2.0)
         shutdown_mt5()
         print("[SHUTDOWN] MT5 closed.")
 